@@ -0,0 +1,38 @@
+import os
+from pathlib import Path
+
+import lightkurve as lk
+
+# ============================================================
+# SHARED SPOC LIGHT-CURVE CACHE
+# ============================================================
+# One FITS file per (TIC, sector), shared by Phase 2 and the
+# validation scripts so reruns never hit MAST twice.
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+CACHE_DIR = PROJECT_ROOT / "data" / "lk_cache"
+
+
+def cache_path(tic_id, sector):
+    return CACHE_DIR / f"tic{int(tic_id)}_s{sector}_spoc.fits"
+
+
+def load_spoc_lightcurve(tic_id, sector):
+    path = cache_path(tic_id, sector)
+    if path.exists():
+        return lk.read(str(path))
+
+    search = lk.search_lightcurve(
+        f"TIC {int(tic_id)}",
+        mission="TESS",
+        sector=sector,
+        author="SPOC"
+    )
+    if len(search) == 0:
+        return None
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    lc = search[0].download(download_dir=str(CACHE_DIR))
+
+    # lightkurve nests downloads under mastDownload/; keep a flat key
+    os.replace(lc.meta["FILENAME"], path)
+    return lc
@@ -1,5 +1,6 @@
 import os
-import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 from astroquery.mast import Observations, Catalogs
 from tqdm import tqdm
@@ -8,7 +9,7 @@ from tqdm import tqdm
 # CONFIG
 # ============================================================
 SECTOR = 18
-CACHE_FILE = "tic_sector18_cache.csv"
+CACHE_FILE = "tic_sector18_cache.parquet"
 OUTPUT_FILE = "sector18_mdwarf_sample.csv"
 
 TEFF_MIN = 2500
@@ -22,7 +23,7 @@ print("\n--- PHASE 1: BUILDING M-DWARF SAMPLE (CACHED, FIXED) ---\n")
 # ============================================================
 if os.path.exists(CACHE_FILE):
     print("Cache found. Loading TIC catalog cache...")
-    tic_df = pd.read_csv(CACHE_FILE)
+    tic_df = pd.read_parquet(CACHE_FILE, engine="pyarrow")
 
 else:
     print("No cache found. Querying MAST Observations (one-time)...")
@@ -42,42 +43,42 @@ else:
     # --------------------------------------------------------
     # STEP 1B: EXTRACT TIC IDs FROM obs_id (CORRECT METHOD)
     # --------------------------------------------------------
-    tic_ids = set()
-    tic_pattern = re.compile(r"-([0-9]{16})-")
-
-    for oid in obs["obs_id"]:
-        if isinstance(oid, str):
-            match = tic_pattern.search(oid)
-            if match:
-                tic_ids.add(int(match.group(1)))
-
-    tic_ids = sorted(tic_ids)
+    obs_ids = pd.Series(np.asarray(obs["obs_id"], dtype=str))
+    tic_ids = np.sort(
+        obs_ids.str.extract(r"-([0-9]{16})-", expand=False)
+        .dropna()
+        .astype(np.int64)
+        .unique()
+    ).tolist()
     print(f"Unique TIC IDs extracted: {len(tic_ids)}")
 
     if len(tic_ids) == 0:
         raise RuntimeError("No TIC IDs extracted — stopping.")
 
     # --------------------------------------------------------
-    # STEP 1C: QUERY TIC CATALOG (CHUNKED)
+    # STEP 1C: QUERY TIC CATALOG (CHUNKED, CONCURRENT)
     # --------------------------------------------------------
-    records = []
+    records = {}
     CHUNK = 1000
-
-    for i in tqdm(range(0, len(tic_ids), CHUNK), desc="Querying TIC catalog"):
-        chunk = tic_ids[i:i + CHUNK]
-        try:
-            r = Catalogs.query_criteria(
-                catalog="Tic",
-                ID=chunk
-            )
-            records.append(r.to_pandas())
-        except Exception as e:
-            print(f"Chunk {i} failed: {e}")
-
-    tic_df = pd.concat(records, ignore_index=True)
+    MAX_WORKERS = 8
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        futures = {
+            ex.submit(Catalogs.query_criteria, catalog="Tic", ID=tic_ids[i:i + CHUNK]): i
+            for i in range(0, len(tic_ids), CHUNK)
+        }
+        for f in tqdm(as_completed(futures), total=len(futures), desc="Querying TIC catalog"):
+            i = futures[f]
+            try:
+                records[i] = f.result().to_pandas()
+            except Exception as e:
+                print(f"Chunk {i} failed: {e}")
+
+    # Keep chunk order so the cache is reproducible
+    tic_df = pd.concat([records[i] for i in sorted(records)], ignore_index=True)
 
     # Cache
-    tic_df.to_csv(CACHE_FILE, index=False)
+    tic_df.to_parquet(CACHE_FILE, engine="pyarrow", compression="snappy", index=False)
     print(f"TIC catalog cache saved to {CACHE_FILE}")
 
 # ============================================================
@@ -1,9 +1,25 @@
-import lightkurve as lk
+import asyncio
 import numpy as np
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")  # headless: no GUI figure managers
 import matplotlib.pyplot as plt
-from scipy.signal import find_peaks
+from scipy.fft import rfft, irfft
+from astropy.io import fits
+from lightkurve.utils import TessQualityFlags
+from astroquery.mast import Observations
+import nifty_ls
+import pyarrow as pa
+import pyarrow.parquet as pq
+import aiohttp
+from multiprocessing import Pool
 import os
+import re
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lc_cache import CACHE_DIR, cache_path
 
 # ======================================================
 # CONFIGURATION
@@ -11,35 +27,90 @@ import os
 SECTOR = 18
 INPUT_SAMPLE = "sector18_mdwarf_sample.csv"   # From Phase 1
 OUTPUT_CSV = "data/processed/phase2_rotation_results_pilot.csv"
+OUTPUT_PARQUET = "data/processed/phase2_rotation_results_pilot.parquet"
 PLOT_DIR = "phase2_plots"
 
 MAX_STARS = 100              # Process first 100, select 50 later
+BIN_SIZE = 2 / 24            # 2-hour bins (days)
 VARIABILITY_CUT = 0.0015     # Save plots only if variability > this
-
-os.makedirs(PLOT_DIR, exist_ok=True)
-
-print("\n--- PHASE 2: ROTATION PERIOD ANALYSIS ---")
-print(f"Sector            : {SECTOR}")
-print(f"Max stars         : {MAX_STARS}")
-print(f"Variability cut   : {VARIABILITY_CUT}\n")
+MAX_CONCURRENT = 16          # Parallel MAST downloads
+PRODUCT_CHUNK = 500          # Observations per get_product_list call
+CHECKPOINT_SIZE = 25         # Stars per batch; results saved after each
+
+MAST_DOWNLOAD_URL = "https://mast.stsci.edu/api/v0.1/Download/file?uri="
+
+RESULT_SCHEMA = pa.schema([
+    ("TIC_ID", pa.int64()),
+    ("Teff", pa.float64()),
+    ("logg", pa.float64()),
+    ("Tmag", pa.float64()),
+    ("LS_Period", pa.float64()),
+    ("LS_Power", pa.float64()),
+    ("ACF_Period", pa.float64()),
+    ("Final_Period", pa.float64()),
+    ("Flag", pa.string()),
+    ("Variability", pa.float64()),
+])
 
 # ======================================================
-# LOAD SAMPLE
+# HELPER: Async, cached download
 # ======================================================
-sample = pd.read_csv(INPUT_SAMPLE)
-
-# ---- Detect TIC column automatically ----
-possible_tic_cols = ["TIC_ID", "ticid", "TIC", "ID"]
-tic_col = None
-for col in possible_tic_cols:
-    if col in sample.columns:
-        tic_col = col
-        break
-
-if tic_col is None:
-    raise RuntimeError(f"No TIC ID column found. Columns: {sample.columns.tolist()}")
+async def fetch(session, semaphore, tic_id, uri):
+    path = cache_path(tic_id, SECTOR)
+    if path.exists():
+        return path
+
+    async with semaphore:
+        try:
+            async with session.get(MAST_DOWNLOAD_URL + uri) as resp:
+                resp.raise_for_status()
+                data = await resp.read()
+        except Exception as e:
+            print(f"  TIC {tic_id} download failed: {e}")
+            return None
+
+    # Write then rename, so an interrupted write never looks cached
+    part = path.with_name(path.name + ".part")
+    with open(part, "wb") as f:
+        f.write(data)
+    os.replace(part, path)
+    return path
+
+
+async def fetch_all(uris):
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+    async with aiohttp.ClientSession() as session:
+        paths = await asyncio.gather(
+            *(fetch(session, semaphore, tic_id, uri) for tic_id, uri in uris.items())
+        )
+    return {tic_id: path for tic_id, path in zip(uris, paths) if path is not None}
 
-print(f"Using TIC column: {tic_col}")
+# ======================================================
+# HELPER: Resolve SPOC light-curve URIs (batched MAST queries)
+# ======================================================
+def resolve_lc_uris(tic_ids):
+    obs = Observations.query_criteria(
+        obs_collection="TESS",
+        dataproduct_type="timeseries",
+        provenance_name="SPOC",
+        sequence_number=SECTOR,
+        target_name=[str(t) for t in tic_ids]
+    )
+
+    # Product filenames look like tess2019306063752-s0018-0000000230073581-0162-s_lc.fits
+    lc_uris = {}
+    tic_pattern = re.compile(r"-([0-9]{16})-")
+
+    for i in range(0, len(obs), PRODUCT_CHUNK):
+        products = Observations.get_product_list(obs[i:i + PRODUCT_CHUNK])
+        products = Observations.filter_products(products, productSubGroupDescription="LC")
+
+        for fname, uri in zip(products["productFilename"], products["dataURI"]):
+            match = tic_pattern.search(fname)
+            if match:
+                lc_uris[int(match.group(1))] = uri
+
+    return lc_uris
 
 # ======================================================
 # HELPER: Harmonic-aware decision
@@ -59,111 +130,310 @@ def choose_rotation_period(P_ls, P_acf):
     return P_ls, "Match"
 
 # ======================================================
-# MAIN LOOP
+# HELPER: Read and normalize in one NumPy pass
 # ======================================================
-results = []
-processed = 0
+def load_normalized(path):
+    with fits.open(path) as hdul:
+        data = hdul["LIGHTCURVE"].data
+        t = np.array(data["TIME"], dtype=float)
+        f = np.array(data["PDCSAP_FLUX"], dtype=float)
+        quality = np.array(data["QUALITY"])
+
+    # Same cadences lk.read (default bitmask) + remove_nans() would keep
+    m = np.isfinite(t) & np.isfinite(f) & ((quality & TessQualityFlags.DEFAULT_BITMASK) == 0)
+    t, f = t[m], f[m]
+    if t.size == 0:
+        return None
 
-for _, row in sample.iterrows():
-    if processed >= MAX_STARS:
-        break
+    f /= np.median(f)
 
-    tic_id = int(row[tic_col])
+    return t, f
 
+
+def load_star(path):
+    # Per-star failures (unreadable file, no usable cadences) only skip
+    # that star
     try:
-        print(f"[{processed+1}/{MAX_STARS}] TIC {tic_id}")
-
-        # --- DOWNLOAD ---
-        search = lk.search_lightcurve(
-            f"TIC {tic_id}",
-            mission="TESS",
-            sector=SECTOR,
-            author="SPOC"
-        )
+        lc = load_normalized(path)
+    except Exception as e:
+        print(f"  {Path(path).name} ERROR: {e}")
+        return None
 
-        if len(search) == 0:
-            print("  No SPOC data — skipping.")
-            continue
+    if lc is None:
+        print(f"  {Path(path).name}: no usable cadences — skipping.")
+    return lc
 
-        lc = search[0].download()
+# ======================================================
+# HELPER: Bin onto a shared regular grid
+# ======================================================
+def bin_to_grid(t, f, i0, n_bins):
+    # Empty bins stay NaN, as with lc.bin(); bin k spans
+    # [(i0 + k) * BIN_SIZE, (i0 + k + 1) * BIN_SIZE)
+    idx = (t // BIN_SIZE).astype(np.int64) - i0
+    counts = np.bincount(idx, minlength=n_bins)
+    with np.errstate(invalid="ignore"):
+        return np.bincount(idx, weights=f, minlength=n_bins) / counts
 
-        # --- PREPROCESS ---
-        lc = lc.remove_nans().normalize()
-        lc_binned = lc.bin(time_bin_size=2/24)
+# ======================================================
+# HELPER: Fold plots (run in worker processes)
+# ======================================================
+def init_worker():
+    # One Agg figure per worker, reused for every plot it draws
+    global fig, ax
+    matplotlib.use("Agg")
+    fig, ax = plt.subplots(figsize=(6, 4))
+
+
+def save_fold_plot(tic_id, time, flux, period, flag):
+    ax.clear()
+    phase = ((time - time[0]) / period + 0.5) % 1 - 0.5
+    ax.scatter(phase, flux, s=2, alpha=0.6)
+    ax.set_xlabel("Phase")
+    ax.set_ylabel("Normalized Flux")
+    ax.set_title(f"TIC {tic_id} | P={period:.2f} d | {flag}")
+    fig.tight_layout()
+    fig.savefig(f"{PLOT_DIR}/TIC{tic_id}_fold.png", dpi=120)
 
-        variability = np.nanstd(lc_binned.flux.value)
+# ======================================================
+# HELPER: Bin, Lomb–Scargle and ACF for a batch of stars
+# ======================================================
+def analyze_batch(raw):
+    tics = list(raw)
+
+    # All stars share the sector baseline, so a common 2h grid gives
+    # equal-length rows that can be processed as one (Nstars, Nbins) array.
+    # Bin edges sit on multiples of BIN_SIZE, so a star's bins do not
+    # depend on which other stars share its batch.
+    i0 = int(min(t[0] for t, _ in raw.values()) // BIN_SIZE)
+    n_bins = int(max(t[-1] for t, _ in raw.values()) // BIN_SIZE) - i0 + 1
+    time = (i0 + np.arange(n_bins) + 0.5) * BIN_SIZE
+
+    flux = np.stack([bin_to_grid(t, f, i0, n_bins) for t, f in raw.values()])
+
+    # Mean-subtracted flux, shared by the variability measure and the ACF
+    x = flux - np.nanmean(flux, axis=1, keepdims=True)
+    variability = np.sqrt(np.nanmean(x * x, axis=1))   # == nanstd(flux)
+
+    # Each star's own filled bins; empty bins never enter its LS
+    good = ~np.isnan(x)
+
+    # Gaps filled with each star's mean (0 after subtraction), ACF only
+    X = np.nan_to_num(x, nan=0.0)
+
+    # --- LOMB–SCARGLE (nifty-ls, batched per gap pattern) ---
+    # Stars with identical filled bins share one nifty-ls call, so every
+    # star is searched on its own points only, as a single-star run would.
+    # Same 0.5–15 d grid as LombScargle.autofrequency(samples_per_peak=5)
+    # over the star's own baseline.
+    # Kept in float64: single-precision finufft distorts low-frequency power.
+    ls_period = np.full(len(tics), np.nan)
+    ls_power = np.full(len(tics), np.nan)
+
+    patterns, group = np.unique(good, axis=0, return_inverse=True)
+    for g, cols in enumerate(patterns):
+        rows = np.flatnonzero(group.ravel() == g)
+        if cols.sum() < 3:   # Too few bins for a period search
+            continue
 
-        # --- LOMB–SCARGLE ---
-        ls = lc_binned.to_periodogram(
-            method="lombscargle",
-            minimum_period=0.5,
-            maximum_period=15
-        )
+        t_ls = time[cols] - time[cols][0]
+        freq_step = 1 / (5 * (t_ls[-1] - t_ls[0]))
+        Nf = 1 + int(round((1 / 0.5 - 1 / 15) / freq_step))
 
-        ls_period = ls.period_at_max_power.value
-        ls_power = ls.max_power.value
-
-        # --- ACF ---
-        flux = np.array(lc_binned.flux.value, dtype=float)
-        time = np.array(lc_binned.time.value, dtype=float)
-
-        if np.any(np.isnan(flux)):
-            flux = np.nan_to_num(flux, nan=np.nanmedian(flux))
-
-        cadence = np.median(np.diff(time))
-        acf = np.correlate(flux - np.mean(flux), flux - np.mean(flux), mode="full")
-        acf = acf[len(acf)//2:]
-        acf /= np.max(acf)
-
-        lags = np.arange(len(acf)) * cadence
-        peaks, _ = find_peaks(acf, height=0.2, distance=10)
-        valid_peaks = [lags[p] for p in peaks if lags[p] > 0.5]
-
-        acf_period = valid_peaks[0] if len(valid_peaks) > 0 else np.nan
-
-        # --- DECISION ---
-        final_period, flag = choose_rotation_period(ls_period, acf_period)
-
-        # --- SAVE RESULT ---
-        results.append({
-        "TIC_ID": int(tic_id),
-        "Teff": float(row["Teff"]) if "Teff" in row and not pd.isna(row["Teff"]) else np.nan,
-        "logg": float(row["logg"]) if "logg" in row and not pd.isna(row["logg"]) else np.nan,
-        "Tmag": float(row["Tmag"]) if "Tmag" in row and not pd.isna(row["Tmag"]) else np.nan,
-        "LS_Period": round(float(ls_period), 4),
-        "LS_Power": round(float(ls_power), 6),
-        "ACF_Period": round(float(acf_period), 4) if not np.isnan(acf_period) else np.nan,
-        "Final_Period": round(float(final_period), 4),
-        "Flag": flag,
-        "Variability": round(float(variability), 6)
-        })
-
-
-        # --- SAVE PLOT (ONLY IF VARIABLE) ---
-        if variability >= VARIABILITY_CUT:
-            fig, ax = plt.subplots(figsize=(6, 4))
-            folded = lc_binned.fold(period=final_period)
-            folded.scatter(ax=ax, s=2, alpha=0.6)
-            ax.set_title(f"TIC {tic_id} | P={final_period:.2f} d | {flag}")
-            plt.tight_layout()
-            plt.savefig(f"{PLOT_DIR}/TIC{tic_id}_fold.png", dpi=120)
-            plt.close(fig)
-
-        processed += 1
+        ls_res = nifty_ls.lombscargle(
+            t_ls, x[np.ix_(rows, cols)],
+            fmin=1 / 15,
+            fmax=1 / 0.5,
+            Nf=Nf,
+            normalization="psd"
+        )
+        # Same amplitude normalization as lightkurve's to_periodogram
+        power = np.sqrt(ls_res.power) * np.sqrt(4.0 / cols.sum())
+        freq = ls_res.freq()
+
+        ls_period[rows] = 1 / freq[np.argmax(power, axis=1)]
+        ls_power[rows] = np.max(power, axis=1)
+
+    # --- ACF (FFT, one call for all stars) ---
+    cadence = BIN_SIZE
+    # FFT autocorrelation out to 2.2 x the longest LS period (15 d), so the
+    # harmonic window of choose_rotation_period is still searched; padding
+    # to N + max_lag is enough to avoid circular wrap-around. Lags past
+    # the data are zero, so the search window is the same for every batch
+    max_lag = int(np.ceil(2.2 * 15 / cadence))
+    n = 1 << (n_bins + max_lag - 1).bit_length()
+    # float32 is ample for the ACF and halves the FFT memory traffic;
+    # scipy.fft keeps float32 -> complex64
+    S = rfft(X.astype(np.float32), n, axis=1)
+    acf = irfft(S * np.conj(S), n, axis=1)[:, :max_lag + 1]
+    acf /= acf[:, :1]
+
+    # First local maximum above 0.2 at lag > 0.5 d (column c is lag c + 1)
+    lags = np.arange(max_lag + 1) * cadence
+    start = np.searchsorted(lags, 0.5, side="right")
+    mid = acf[:, 1:-1]
+    is_peak = (mid > acf[:, :-2]) & (mid >= acf[:, 2:]) & (mid > 0.2)
+    is_peak[:, :max(start - 1, 0)] = False
+
+    first = np.argmax(is_peak, axis=1) + 1
+    acf_period = np.where(is_peak.any(axis=1), lags[first], np.nan)
+
+    return tics, time, flux, variability, ls_period, ls_power, acf_period
 
-    except Exception as e:
-        print(f"  ERROR: {e}")
-        continue
+# ======================================================
+# HELPER: Save results (atomic rewrite)
+# ======================================================
+def save_results(table):
+    # Write then rename, so an interrupted write never replaces the
+    # previous checkpoint with a truncated file
+    tmp = OUTPUT_PARQUET + ".tmp"
+    pq.write_table(table, tmp, compression="snappy")
+    os.replace(tmp, OUTPUT_PARQUET)
 
 # ======================================================
-# EXPORT RESULTS
+# HELPER: Export (Parquet results -> CSV + summary)
 # ======================================================
-df = pd.DataFrame(results)
-df.to_csv(OUTPUT_FILE, index=False)
+def export_results():
+    df = pq.read_table(OUTPUT_PARQUET).to_pandas()
+    df.to_csv(OUTPUT_CSV, index=False)   # Human-readable copy
+
+    print("\n--- PHASE 2 COMPLETE ---")
+    print(f"Stars processed : {len(df)}")
+    print(f"Results saved   : {OUTPUT_PARQUET}")
+    print(f"                  {OUTPUT_CSV}")
+    print(f"Plots directory : {PLOT_DIR}/")
+    print("\nFlag summary:")
+    print(df["Flag"].value_counts())
 
-print("\n--- PHASE 2 COMPLETE ---")
-print(f"Stars processed : {len(df)}")
-print(f"Results saved   : {OUTPUT_FILE}")
-print(f"Plots directory : {PLOT_DIR}/")
-print("\nFlag summary:")
-print(df["Flag"].value_counts())
+# ======================================================
+# MAIN
+# ======================================================
+def main():
+    os.makedirs(PLOT_DIR, exist_ok=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+    print("\n--- PHASE 2: ROTATION PERIOD ANALYSIS ---")
+    print(f"Sector            : {SECTOR}")
+    print(f"Max stars         : {MAX_STARS}")
+    print(f"Variability cut   : {VARIABILITY_CUT}\n")
+
+    # ======================================================
+    # LOAD SAMPLE
+    # ======================================================
+    # Only the Phase 1 columns used here, with fixed dtypes; Phase 1
+    # writes Tmag only when the TIC provides it, so absent stellar
+    # columns become NaN
+    sample_dtypes = {"ID": "int64", "Teff": "float64", "logg": "float64", "Tmag": "float64"}
+    sample = pd.read_csv(
+        INPUT_SAMPLE,
+        usecols=lambda c: c in sample_dtypes,
+        dtype=sample_dtypes
+    )
+
+    if "ID" not in sample.columns:
+        raise RuntimeError(f"No ID column in {INPUT_SAMPLE}.")
+
+    sample = sample.reindex(columns=list(sample_dtypes))
+
+    # ---- Column arrays (avoids per-row Series construction) ----
+    tic_arr = sample["ID"].to_numpy()
+    teff_arr = sample["Teff"].to_numpy()
+    logg_arr = sample["logg"].to_numpy()
+    tmag_arr = sample["Tmag"].to_numpy()
+
+    # ======================================================
+    # RESUME (SKIP STARS ALREADY WRITTEN)
+    # ======================================================
+    done = None
+    if os.path.exists(OUTPUT_PARQUET):
+        done = pq.read_table(OUTPUT_PARQUET).cast(RESULT_SCHEMA)
+        print(f"Resuming: {done.num_rows} stars already in {OUTPUT_PARQUET}")
+
+    done_tics = set(done.column("TIC_ID").to_pylist()) if done is not None else set()
+    remaining = [int(t) for t in tic_arr if int(t) not in done_tics]
+    n_wanted = MAX_STARS - len(done_tics)
+
+    if n_wanted <= 0 or len(remaining) == 0:
+        print("Nothing left to process.")
+        export_results()
+        return
+
+    # ======================================================
+    # PROCESS IN BATCHES (CHECKPOINT AFTER EACH)
+    # ======================================================
+    # Walk the sample in order until MAX_STARS stars have results;
+    # stars without SPOC data, failed downloads or unusable files are
+    # replaced by the next rows. Results are saved after every batch,
+    # so a crash only loses the batch in progress.
+    results = done
+    star_idx = {int(t): i for i, t in enumerate(tic_arr)}
+    n_new = 0
+    pos = 0
+
+    with Pool(os.cpu_count(), initializer=init_worker) as pool:
+        while n_new < n_wanted and pos < len(remaining):
+            batch = remaining[pos:pos + min(CHECKPOINT_SIZE, n_wanted - n_new)]
+            pos += len(batch)
+
+            # --- RESOLVE + DOWNLOAD (ASYNC, CACHED) ---
+            lc_uris = resolve_lc_uris(batch)
+            lc_paths = asyncio.run(fetch_all({t: lc_uris[t] for t in batch if t in lc_uris}))
+
+            # --- LOAD (PARALLEL) ---
+            loaded = pool.map(load_star, list(lc_paths.values()))
+            raw = {tic_id: lc for tic_id, lc in zip(lc_paths, loaded) if lc is not None}
+
+            if len(raw) == 0:
+                continue
+
+            # --- BATCHED LOMB–SCARGLE + ACF ---
+            tics, time, flux, variability, ls_period, ls_power, acf_period = analyze_batch(raw)
+            del raw
+
+            # --- DECISION ---
+            rows = []
+            plot_jobs = []
+
+            for k, tic_id in enumerate(tics):
+                i = star_idx[tic_id]
+
+                final_period, flag = choose_rotation_period(ls_period[k], acf_period[k])
+
+                rows.append({
+                "TIC_ID": tic_id,
+                "Teff": float(teff_arr[i]),
+                "logg": float(logg_arr[i]),
+                "Tmag": float(tmag_arr[i]),
+                "LS_Period": round(float(ls_period[k]), 4),
+                "LS_Power": round(float(ls_power[k]), 6),
+                "ACF_Period": round(float(acf_period[k]), 4),
+                "Final_Period": round(float(final_period), 4),
+                "Flag": flag,
+                "Variability": round(float(variability[k]), 6)
+                })
+
+                # Plot only if variable
+                if variability[k] >= VARIABILITY_CUT:
+                    plot_jobs.append((tic_id, time, flux[k], final_period, flag))
+
+            # --- CHECKPOINT ---
+            new = pa.Table.from_pylist(rows, schema=RESULT_SCHEMA)
+            results = new if results is None else pa.concat_tables([results, new])
+            save_results(results)
+
+            n_new += len(rows)
+            print(f"Stars processed: {n_new}/{n_wanted}")
+
+            # --- SAVE PLOTS (PARALLEL) ---
+            pool.starmap(save_fold_plot, plot_jobs)
+
+    if results is None:
+        raise RuntimeError("No light curves loaded — stopping.")
+
+    # ======================================================
+    # EXPORT RESULTS
+    # ======================================================
+    export_results()
+
+
+if __name__ == "__main__":
+    main()
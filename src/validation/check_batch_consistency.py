@@ -0,0 +1,49 @@
+import numpy as np
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "phase2_rotation_pipeline"))
+from lc_cache import CACHE_DIR
+from phase2_run_rotation_batch import SECTOR, analyze_batch, load_star
+
+# -----------------------------
+# VALIDATION: Phase 2 results must not depend on batch membership
+# -----------------------------
+N_STARS = 5
+GAP_START = 5.0   # days after the first cadence
+GAP_LENGTH = 7.0  # days
+
+print(f"\n--- BATCH CONSISTENCY CHECK (SECTOR {SECTOR}) ---\n")
+
+# --- LOAD CACHED LIGHT CURVES ---
+raw = {}
+for path in sorted(CACHE_DIR.glob(f"tic*_s{SECTOR}_spoc.fits")):
+    lc = load_star(path)
+    if lc is not None:
+        raw[int(path.name[3:].split("_")[0])] = lc
+    if len(raw) == N_STARS:
+        break
+
+if len(raw) < 2:
+    raise RuntimeError(f"Need at least 2 cached sector {SECTOR} light curves in {CACHE_DIR}.")
+
+# --- GIVE ONE STAR A GAP OF ITS OWN ---
+tic_id = next(iter(raw))
+t, f = raw[tic_id]
+keep = (t < t[0] + GAP_START) | (t >= t[0] + GAP_START + GAP_LENGTH)
+raw[tic_id] = (t[keep], f[keep])
+
+print(f"TIC {tic_id}: {GAP_LENGTH:.0f} d gap injected, batched with {len(raw) - 1} other stars")
+
+# --- SINGLE vs BATCHED ---
+single = analyze_batch({tic_id: raw[tic_id]})
+batched = analyze_batch(raw)
+k = batched[0].index(tic_id)
+
+for name, i in [("LS_Period", 4), ("LS_Power", 5), ("ACF_Period", 6)]:
+    a, b = single[i][0], batched[i][k]
+    print(f"{name:<11}: single = {a:.6g} | batched = {b:.6g}")
+    np.testing.assert_allclose(b, a, rtol=1e-6, equal_nan=True, err_msg=name)
+
+print("\nBatched results match the single-star run.")
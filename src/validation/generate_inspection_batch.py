@@ -1,9 +1,14 @@
 import pandas as pd
-import lightkurve as lk
+import matplotlib
+matplotlib.use("Agg")  # headless: no GUI figure managers
 import matplotlib.pyplot as plt
 import os
+import sys
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lc_cache import load_spoc_lightcurve
+
 # =========================================================
 # CONFIGURATION (MATCHES YOUR REPO)
 # =========================================================
@@ -24,6 +29,9 @@ OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 SECTOR = 18
 N_MATCH_SAMPLE = 15
 
+# Flags routed to visual inspection (plus a random sample of Matches)
+HARMONIC_FLAGS = {"Harmonic_Corrected", "Subharmonic_Corrected", "Ambiguous"}
+
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 print("\n--- GENERATING PILOT INSPECTION BATCH ---\n")
@@ -31,7 +39,16 @@ print("\n--- GENERATING PILOT INSPECTION BATCH ---\n")
 # =========================================================
 # LOAD RESULTS TABLE
 # =========================================================
-df = pd.read_csv(INPUT_CSV)
+# Only the columns used below (either naming scheme), with fixed dtypes
+INPUT_DTYPES = {
+    "TIC_ID": "int64",
+    "ID": "int64",
+    "Final_Period": "float64",
+    "Pipeline_Period_days": "float64",
+    "Flag": str,
+    "Pipeline_Flag": str,
+}
+df = pd.read_csv(INPUT_CSV, usecols=lambda c: c in INPUT_DTYPES, dtype=INPUT_DTYPES)
 
 # =========================================================
 # COLUMN NORMALIZATION (CANONICAL SCHEMA)
@@ -59,10 +76,13 @@ missing = required - set(df.columns)
 if missing:
     raise RuntimeError(f"CSV missing required columns: {missing}")
 
+# Few distinct flag values: compare integer category codes, not strings
+df["Flag"] = df["Flag"].astype("category")
+
 # =========================================================
 # SELECT STARS TO INSPECT
 # =========================================================
-harmonic = df[df["Flag"].str.contains("Harmonic|Ambiguous", case=False, na=False)]
+harmonic = df[df["Flag"].isin(HARMONIC_FLAGS)]
 matches = df[df["Flag"] == "Match"]
 
 matches_sample = matches.sample(
@@ -79,15 +99,11 @@ print(f"  Match (control)      : {len(matches_sample)}\n")
 # =========================================================
 # PLOT GENERATION
 # =========================================================
-def make_validation_plot(tic_id, period, flag):
+def make_validation_plot(fig, axes, tic_id, period, flag):
     print(f"Plotting TIC {tic_id} | P={period:.3f} d | {flag}")
 
     try:
-        lc = lk.search_lightcurve(
-            f"TIC {tic_id}",
-            sector=SECTOR,
-            author="SPOC"
-        ).download()
+        lc = load_spoc_lightcurve(tic_id, SECTOR)
 
         if lc is None:
             print("  -> No data found")
@@ -95,7 +111,8 @@ def make_validation_plot(tic_id, period, flag):
 
         lc = lc.normalize().remove_nans()
 
-        fig, axes = plt.subplots(1, 2, figsize=(12, 5), constrained_layout=True)
+        axes[0].clear()
+        axes[1].clear()
         fig.suptitle(
             f"TIC {tic_id} | Pipeline Period = {period:.3f} d | Flag: {flag}",
             fontsize=14
@@ -117,8 +134,7 @@ def make_validation_plot(tic_id, period, flag):
         axes[1].set_xlabel("Phase")
 
         outname = f"TIC{tic_id}_{flag}.png"
-        plt.savefig(os.path.join(OUTPUT_DIR, outname), dpi=120)
-        plt.close()
+        fig.savefig(os.path.join(OUTPUT_DIR, outname), dpi=120)
 
     except Exception as e:
         print(f"  -> ERROR: {e}")
@@ -126,12 +142,22 @@ def make_validation_plot(tic_id, period, flag):
 # =========================================================
 # RUN
 # =========================================================
-for _, row in targets.iterrows():
+# One figure reused for every target
+fig, axes = plt.subplots(1, 2, figsize=(12, 5), constrained_layout=True)
+
+for tic_id, period, flag in zip(
+    targets["TIC_ID"].to_numpy(),
+    targets["Period"].to_numpy(),
+    targets["Flag"].to_numpy()
+):
     make_validation_plot(
-        tic_id=int(row["TIC_ID"]),
-        period=float(row["Period"]),
-        flag=row["Flag"]
+        fig, axes,
+        tic_id=int(tic_id),
+        period=float(period),
+        flag=flag
     )
 
+plt.close(fig)
+
 print("\n--- PILOT VALIDATION PLOTS GENERATED ---")
 print(f"Saved to: {OUTPUT_DIR}")
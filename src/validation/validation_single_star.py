@@ -1,20 +1,24 @@
-import lightkurve as lk
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import find_peaks
+from astropy.timeseries import LombScargle
+import nifty_ls  # noqa: F401  (registers method="fastnifty" with astropy)
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from lc_cache import load_spoc_lightcurve
 
 # -----------------------------
 # VALIDATION: Minimalist SPOC run
 # -----------------------------
-TIC_ID = "TIC 445493624"
+TIC_ID = 445493624
 SECTOR = 18
 
-print(f"\n--- MINIMALIST VALIDATION RUN FOR {TIC_ID} (SECTOR {SECTOR}) ---\n")
+print(f"\n--- MINIMALIST VALIDATION RUN FOR TIC {TIC_ID} (SECTOR {SECTOR}) ---\n")
 
-# --- DOWNLOAD (direct, avoids discovery portal issues) ---
-lc_file = lk.search_lightcurvefile(TIC_ID, mission="TESS", sector=SECTOR, author="SPOC").download()
-# Use PDCSAP flux (NASA corrected)
-lc = lc_file.PDCSAP_FLUX
+# --- DOWNLOAD (cached, shared with Phase 2) ---
+# Use PDCSAP flux (NASA corrected) — lightkurve's default flux column
+lc = load_spoc_lightcurve(TIC_ID, SECTOR)
 
 print(f"Downloaded: Author={lc.author}, Sector={getattr(lc, 'sector', SECTOR)}")
 
@@ -27,10 +31,17 @@ lc_binned = lc_clean.bin(time_bin_size=2/24)  # 2 hours
 
 print("Minimal preprocessing done (flatten skipped).")
 
-# --- LOMB-SCARGLE PERIODOGRAM ---
-periodogram = lc_binned.to_periodogram(method="lombscargle", minimum_period=0.5, maximum_period=15)
-ls_period = periodogram.period_at_max_power.value
-ls_power = periodogram.max_power.value
+flux = np.array(lc_binned.flux.value, dtype=float)
+time = np.array(lc_binned.time.value, dtype=float)
+good = np.isfinite(flux)
+
+# --- LOMB-SCARGLE PERIODOGRAM (nifty-ls) ---
+frequency, power = LombScargle(time[good], flux[good], normalization="psd").autopower(
+    method="fastnifty", minimum_frequency=1 / 15, maximum_frequency=1 / 0.5, samples_per_peak=5
+)
+power = np.sqrt(power) * np.sqrt(4.0 / good.sum())  # lightkurve amplitude normalization
+ls_period = 1 / frequency[np.argmax(power)]
+ls_power = np.max(power)
 
 print("\n[Lomb-Scargle]")
 print(f"  Detected period : {ls_period:.4f} days")
@@ -38,21 +49,28 @@ print(f"  Peak power      : {ls_power:.6f}")
 print("  (Literature ref: ~3.638 days)")
 
 # --- ACF (on un-flattened, binned data) ---
-flux = np.array(lc_binned.flux.value, dtype=float)
-time = np.array(lc_binned.time.value, dtype=float)
 if np.any(np.isnan(flux)):
     flux = np.nan_to_num(flux, nan=np.nanmedian(flux))
 
 cadence = np.median(np.diff(time))
-acf = np.correlate(flux - np.mean(flux), flux - np.mean(flux), mode="full")
-acf = acf[len(acf)//2:]
-acf /= np.max(acf)
+# FFT autocorrelation out to 2.2 x the longest LS period (15 d), so the
+# harmonic window of choose_rotation_period is still searched; padding
+# to N + max_lag is enough to avoid circular wrap-around
+max_lag = min(int(np.ceil(2.2 * 15 / cadence)), len(flux) - 1)
+x = flux - flux.mean()
+n = 1 << (len(x) + max_lag - 1).bit_length()
+F = np.fft.rfft(x, n)
+acf = np.fft.irfft(F * np.conj(F), n)[:max_lag + 1]
+acf /= acf[0]
 lags = np.arange(len(acf)) * cadence
 
-peaks, _ = find_peaks(acf, height=0.2, distance=10)
-valid_peaks = [lags[p] for p in peaks if lags[p] > 0.5]
-if len(valid_peaks) > 0:
-    acf_period = valid_peaks[0]
+# First local maximum above 0.2 at lag > 0.5 d (index i is lag i + 1)
+start = np.searchsorted(lags, 0.5, side="right")
+mid = acf[1:-1]
+is_peak = (mid > acf[:-2]) & (mid >= acf[2:]) & (mid > 0.2)
+is_peak[:max(start - 1, 0)] = False
+if is_peak.any():
+    acf_period = lags[np.argmax(is_peak) + 1]
     print(f"[ACF] Estimated period: {acf_period:.4f} days")
 else:
     acf_period = np.nan
@@ -65,7 +83,9 @@ lc_binned.scatter(ax=axes[0], s=2)
 axes[0].set_title(f"TESS Sector {SECTOR} — Normalized PDCSAP (no flatten)")
 axes[0].set_ylabel("Normalized flux")
 
-periodogram.plot(ax=axes[1])
+axes[1].plot(1 / frequency, power, color="black", lw=1)
+axes[1].set_xlabel("Period [days]")
+axes[1].set_ylabel("Amplitude")
 axes[1].axvline(3.638, color="green", linestyle="--", label="Literature 3.638 d")
 axes[1].legend()
 axes[1].set_title(f"Periodogram (peak: {ls_period:.4f} d)")